@@ -0,0 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor
+from db_utils import RDSDatabaseConnector, load_yaml
+import os
+import resource
+import sys
+import tempfile
+import time
+
+
+# Benchmarks for the extraction methods in db_utils.py
+# These are meant to be run against a local PostgreSQL database standing in for RDS,
+# with its login details in 'local_credentials.yaml' using the same keys as 'credentials.yaml'
+
+# Creating a function to time how long a function call takes, keeping the best of a few runs
+def time_function(function, *args, repeats=3, **kwargs):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+# Creating a function to load the sample csv into the local database so there is something to extract
+def load_sample_table(connector, table_name='loan_payments', csv_path='loan payments.csv'):
+    df = connector.read_csv(csv_path)
+    df.to_sql(table_name, connector.engine, if_exists='replace', index=False)
+    return len(df)
+
+# Comparing pd.read_sql_table (get_data) against COPY ... TO STDOUT (copy_data)
+def benchmark_extraction(connector, table_name='loan_payments'):
+    get_data_time = time_function(connector.get_data, table_name)
+    copy_data_time = time_function(connector.copy_data, table_name)
+    print(f'get_data:  {get_data_time:.3f}s')
+    print(f'copy_data: {copy_data_time:.3f}s ({get_data_time / copy_data_time:.1f}x faster)')
+
+# Comparing pulling the whole table and grouping in pandas against a GROUP BY run by the database (aggregate)
+def benchmark_aggregation(connector, table_name='loan_payments', group_by='grade'):
+    aggregations = {'loan_amount': 'sum', 'total_payment': 'sum', 'recoveries': 'sum'}
+
+    def pandas_path():
+        df = connector.get_data(table_name)
+        return df.groupby(group_by)[list(aggregations)].sum()
+
+    pull_time = time_function(pandas_path)
+    aggregate_time = time_function(connector.aggregate, table_name, [group_by], aggregations)
+    pulled_bytes = connector.get_data(table_name).memory_usage(deep=True).sum()
+    aggregated_bytes = connector.aggregate(table_name, [group_by], aggregations).memory_usage(deep=True).sum()
+    print(f'get_data + groupby: {pull_time:.3f}s, {pulled_bytes / 1024 ** 2:.1f} MB returned')
+    print(f'aggregate:          {aggregate_time:.3f}s, {aggregated_bytes / 1024:.1f} KB returned ({pull_time / aggregate_time:.1f}x faster)')
+
+# Creating a function to make a bigger copy of the sample csv by repeating its rows, for testing at a larger scale
+def replicate_csv(csv_path='loan payments.csv', copies=100, output_path='loan payments x100.csv'):
+    with open(csv_path, 'rb') as source:
+        header = source.readline()
+        body = source.read()
+    with open(output_path, 'wb') as output:
+        output.write(header)
+        for _ in range(copies):
+            output.write(body)
+    return output_path
+
+# Reading a csv in a fresh process so that its peak memory (RSS) isn't affected by earlier runs
+def read_csv_in_process(csv_path, engine, block_size):
+    start = time.perf_counter()
+    RDSDatabaseConnector().read_csv(csv_path, engine=engine, block_size=block_size)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Comparing the pandas C parser against the multithreaded pyarrow csv reader on the sample file and a 100x copy of it
+# The 100x copy is written to a temporary folder and deleted afterwards
+def benchmark_csv_engines(csv_path='loan payments.csv', copies=100, block_sizes=(None, 16 * 1024 ** 2)):
+    with tempfile.TemporaryDirectory() as scratch:
+        large_path = replicate_csv(csv_path, copies, os.path.join(scratch, f'loans x{copies}.csv'))
+        for path in [csv_path, large_path]:
+            print(f'{path} ({os.path.getsize(path) / 1024 ** 2:.0f} MB)')
+            runs = [('c', None)] + [('pyarrow', block_size) for block_size in block_sizes]
+            for engine, block_size in runs:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    seconds, peak_mb = executor.submit(read_csv_in_process, path, engine, block_size).result()
+                label = engine if block_size is None else f'{engine} (block_size={block_size // 1024 ** 2} MB)'
+                print(f'  {label:32} {seconds:.2f}s, peak RSS {peak_mb:.0f} MB')
+
+# Comparing typical EDA queries run by DuckDB straight over the exported files against loading everything into pandas first
+# The Parquet copy is written to a temporary folder so it can't overwrite a real export in the working directory
+def benchmark_queries(csv_path='loan payments.csv'):
+    connector = RDSDatabaseConnector()
+    connector.df = connector.read_csv(csv_path)
+    with tempfile.TemporaryDirectory() as scratch:
+        connector.export_to_parquet(os.path.join(scratch, 'loans'))
+        parquet_path = os.path.join(scratch, 'loans.parquet')
+        charge_off = "CASE WHEN loan_status LIKE '%Charged Off' THEN 1.0 ELSE 0.0 END"
+        for column in ['grade', 'purpose']:
+            query = f'SELECT {column}, AVG({charge_off}) AS charge_off_rate FROM loans GROUP BY {column} ORDER BY {column}'
+
+            def pandas_path():
+                df = connector.read_csv(csv_path)
+                return df['loan_status'].astype(str).str.endswith('Charged Off').groupby(df[column], observed=True).mean()
+
+            pandas_time = time_function(pandas_path)
+            print(f'Charge-off rate by {column}')
+            print(f'  read_csv + groupby:   {pandas_time:.3f}s')
+            for path in [csv_path, parquet_path]:
+                duckdb_time = time_function(connector.query_file, path, query)
+                print(f'  query_file ({path.rsplit(".", 1)[-1]}): {duckdb_time:.3f}s ({pandas_time / duckdb_time:.1f}x faster)')
+
+# Run with --csv to only run the file benchmarks, which don't need a database
+if __name__ == '__main__':
+    if '--csv' not in sys.argv:
+        local = RDSDatabaseConnector(load_yaml('local_credentials.yaml'))
+        local.start_sqlalchemy_engine()
+        rows = load_sample_table(local)
+        print(f'Loaded {rows} rows into the local database')
+        benchmark_extraction(local)
+        benchmark_aggregation(local)
+    benchmark_csv_engines()
+    benchmark_queries()
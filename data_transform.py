@@ -0,0 +1,86 @@
+from db_utils import as_pandas
+import pandas as pd
+
+
+# Creating a class to deal with the missing values in the loans dataframe returned by RDSDatabaseConnector
+# Every step works on whole columns at once (isna().mean(), fillna, groupby().transform()) rather than looping over rows,
+# so it stays quick on millions of rows
+# Each method updates self.df and returns it, so the steps can be run one after another
+class DataTransform:
+    def __init__(self, df):
+        # Polars frames from the 'polars' or 'polars-lazy' backends are converted to pandas
+        self.df = as_pandas(df).copy()
+
+    # Creating a method to get the fraction of missing values in every column, highest first
+    def null_fractions(self):
+        return self.df.isna().mean().sort_values(ascending=False)
+
+    # Creating a method to drop every column where more than threshold of the values are missing
+    def drop_null_columns(self, threshold=0.5):
+        fractions = self.null_fractions()
+        self.df = self.df.drop(columns=fractions[fractions > threshold].index)
+        return self.df
+
+    # Creating a method to fill missing values with each column's median
+    # Integer columns get the rounded median so they stay whole numbers
+    def impute_median(self, columns):
+        columns = [column for column in columns if column in self.df.columns]
+        if not columns:
+            return self.df
+        medians = self.df[columns].median()
+        integers = [column for column in columns if pd.api.types.is_integer_dtype(self.df[column].dtype)]
+        medians[integers] = medians[integers].round()
+        self.df[columns] = self.df[columns].fillna(medians)
+        return self.df
+
+    # Creating a method to fill missing values with each column's most common value
+    def impute_mode(self, columns):
+        columns = [column for column in columns if column in self.df.columns]
+        if not columns:
+            return self.df
+        modes = self.df[columns].mode(dropna=True).iloc[0]
+        self.df = self.df.fillna(modes.to_dict())
+        return self.df
+
+    # Creating a method to fill missing values with the median (or another statistic) of their group,
+    # e.g. impute_by_group('int_rate', 'sub_grade') fills each missing rate with the typical rate for that loan's sub grade
+    # Rows whose whole group is missing fall back to the column's overall median
+    def impute_by_group(self, column, group_by, statistic='median'):
+        group_values = self.df.groupby(group_by, observed=True)[column].transform(statistic)
+        filled = self.df[column].fillna(group_values)
+        if pd.api.types.is_integer_dtype(self.df[column].dtype):
+            filled = filled.round()
+        self.df[column] = filled.fillna(self.df[column].median())
+        return self.df
+
+    # Creating a method to fill missing values from another column, e.g. funded_amount from loan_amount
+    def impute_from(self, column, source):
+        self.df[column] = self.df[column].fillna(self.df[source])
+        return self.df
+
+    # Creating a method to run the usual clean up of the loans data:
+    # drop the mostly empty columns, fill int_rate from the sub grade, funded_amount from loan_amount,
+    # then any other missing numbers with the median and any other missing categories with the most common value
+    def impute_loans(self, threshold=0.5):
+        self.drop_null_columns(threshold)
+        if {'int_rate', 'sub_grade'}.issubset(self.df.columns):
+            self.impute_by_group('int_rate', 'sub_grade')
+        if {'funded_amount', 'loan_amount'}.issubset(self.df.columns):
+            self.impute_from('funded_amount', 'loan_amount')
+        missing = self.df.columns[self.df.isna().any()]
+        numeric = [column for column in missing if pd.api.types.is_numeric_dtype(self.df[column].dtype)]
+        categorical = [column for column in missing if column not in numeric]
+        if numeric:
+            self.impute_median(numeric)
+        if categorical:
+            self.impute_mode(categorical)
+        return self.df
+
+# Testing methods below, will remove later
+
+# from db_utils import RDSDatabaseConnector
+# df = RDSDatabaseConnector().read_csv("loan payments.csv")
+# transform = DataTransform(df)
+# print(transform.null_fractions())
+# transform.impute_loans(threshold=0.5)
+# print(transform.null_fractions())
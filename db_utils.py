@@ -1,8 +1,23 @@
-from sqlalchemy import create_engine
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import deque
+from itertools import repeat
+import gzip
+import hashlib
+import io
+import numpy as np
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 import pandas as pd
-import psycopg2
 import yaml
 
+# sqlalchemy and psycopg2 are only imported inside the methods that talk to the database,
+# so importing this module just to use read_csv stays quick and doesn't need the database drivers
+
 
 # Creating a function to load credentials from a YAML file
 def load_yaml(filename):
@@ -11,34 +26,1376 @@ def load_yaml(filename):
     file.close() # closing file
     return opened_file
 
-credentials = load_yaml('credentials.yaml')
+# Credentials are loaded the first time they are needed rather than when this module is imported,
+# and the RDS_CREDENTIALS environment variable can point at a different YAML file
+# Any of the individual keys (RDS_HOST, RDS_PASSWORD, ...) can also be overridden by an environment variable of the same name
+credential_keys = ['RDS_HOST', 'RDS_PORT', 'RDS_DATABASE', 'RDS_USER', 'RDS_PASSWORD']
+_credentials = None
+
+def load_credentials(filename='credentials.yaml'):
+    global _credentials
+    if _credentials is None:
+        path = os.environ.get('RDS_CREDENTIALS', filename)
+        creds = load_yaml(path) if os.path.exists(path) else {}
+        for key in credential_keys:
+            if key in os.environ:
+                creds[key] = os.environ[key]
+        missing = [key for key in credential_keys if key not in creds]
+        if missing:
+            raise KeyError(f"Missing database credentials {missing}, add them to '{path}' or set them as environment variables")
+        _credentials = creds
+    return _credentials
+
+# Keeps `from db_utils import credentials` working, it is only loaded when accessed
+def __getattr__(name):
+    if name == 'credentials':
+        return load_credentials()
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+# Declared dtypes for the loan_payments columns described in loan_data_dict.md
+# Low-cardinality text fields become categoricals, whole numbers use the smallest integer width that fits,
+# and whole-number columns containing nulls use pandas' nullable integers (capital 'I') instead of falling back to float64
+# Money amounts stay float64 so no pennies are lost to float32 rounding
+loan_payments_dtypes = {
+    'id': 'int32',
+    'member_id': 'int32',
+    'loan_amount': 'int32',
+    'funded_amount': 'float64',
+    'funded_amount_inv': 'float64',
+    'term': 'category',
+    'int_rate': 'float32',
+    'instalment': 'float64',
+    'grade': 'category',
+    'sub_grade': 'category',
+    'employment_length': 'category',
+    'home_ownership': 'category',
+    'annual_inc': 'float64',
+    'verification_status': 'category',
+    'issue_date': 'category',
+    'loan_status': 'category',
+    'payment_plan': 'category',
+    'purpose': 'category',
+    'dti': 'float32',
+    'delinq_2yrs': 'int8',
+    'earliest_credit_line': 'category',
+    'inq_last_6mths': 'int8',
+    'mths_since_last_delinq': 'Int16',
+    'mths_since_last_record': 'Int16',
+    'open_accounts': 'int16',
+    'total_accounts': 'int16',
+    'out_prncp': 'float64',
+    'out_prncp_inv': 'float64',
+    'total_payment': 'float64',
+    'total_payment_inv': 'float64',
+    'total_rec_prncp': 'float64',
+    'total_rec_int': 'float64',
+    'total_rec_late_fee': 'float64',
+    'recoveries': 'float64',
+    'collection_recovery_fee': 'float64',
+    'last_payment_date': 'category',
+    'last_payment_amount': 'float64',
+    'next_payment_date': 'category',
+    'last_credit_pull_date': 'category',
+    'collections_12_mths_ex_med': 'Int8',
+    'mths_since_last_major_derog': 'Int16',
+    'policy_code': 'int8',
+    'application_type': 'category',
+}
+
+# The dataframe libraries RDSDatabaseConnector can return data as
+backends = ['pandas', 'polars', 'polars-lazy']
+
+# Creating a function to tell whether a dataframe is a Polars DataFrame or LazyFrame, without needing Polars installed
+def is_polars(df):
+    return type(df).__module__.split('.')[0] == 'polars'
+
+# Creating a function to turn a Polars DataFrame or LazyFrame into a pandas dataframe, passing pandas dataframes through unchanged
+def as_pandas(df):
+    if is_polars(df):
+        df = df.collect() if hasattr(df, 'collect') else df
+        df = df.to_pandas()
+    return df
+
+# Columns stored as month-year strings such as 'Jan-2021'
+month_year_columns = ['issue_date', 'earliest_credit_line', 'last_payment_date', 'next_payment_date', 'last_credit_pull_date']
+
+# Creating a function to parse a column of month-year strings
+# There are only a few hundred distinct values however many rows there are, so each distinct value is parsed once
+# with an explicit format and the results are broadcast back out to the rows through their integer codes
+# to='datetime' returns datetime64 values on the first of the month, to='period' returns monthly periods
+def parse_month_year(series, to='datetime'):
+    if to not in ('datetime', 'period'):
+        raise ValueError("to must be 'datetime' or 'period'")
+    if pd.api.types.is_datetime64_any_dtype(series):
+        parsed = series
+    elif isinstance(series.dtype, pd.PeriodDtype):
+        parsed = series.dt.to_timestamp()
+    else:
+        codes, uniques = pd.factorize(series)
+        lookup = pd.to_datetime(pd.Index(uniques).astype(str), format='%b-%Y')
+        # missing values have a code of -1, which take() fills with NaT
+        parsed = pd.Series(lookup.array.take(codes, allow_fill=True), index=series.index, name=series.name)
+    if to == 'period':
+        return parsed.dt.to_period('M')
+    return parsed
+
+# Creating a function to convert all of the month-year columns present in a dataframe from read_csv or get_data
+# Polars frames are converted with Polars expressions, and as Polars has no period type to='period' gives dates on the first of the month
+def convert_month_year_columns(df, columns=month_year_columns, to='datetime'):
+    if is_polars(df):
+        import polars as pl
+        present = [column for column in columns if column in df.collect_schema().names()]
+        target = pl.Datetime if to == 'datetime' else pl.Date
+        return df.with_columns([
+            pl.concat_str([pl.lit('01-'), pl.col(column).cast(pl.String)]).str.strptime(pl.Date, '%d-%b-%Y', strict=False).cast(target).alias(column)
+            for column in present
+        ])
+    df = df.copy()
+    for column in columns:
+        if column in df.columns:
+            df[column] = parse_month_year(df[column], to=to)
+    return df
+
+# Creating a function to compare the memory used by each column of two versions of the same dataframe
+# Either version can be a pandas or Polars dataframe, Polars ones are converted to pandas first
+def memory_report(before, after):
+    before, after = as_pandas(before), as_pandas(after)
+    report = pd.DataFrame({
+        'before_dtype': before.dtypes.astype(str),
+        'after_dtype': after.dtypes.astype(str),
+        'before_bytes': before.memory_usage(deep=True, index=False),
+        'after_bytes': after.memory_usage(deep=True, index=False),
+    })
+    total = pd.DataFrame({
+        'before_dtype': [''],
+        'after_dtype': [''],
+        'before_bytes': [report['before_bytes'].sum()],
+        'after_bytes': [report['after_bytes'].sum()],
+    }, index=['total'])
+    report = pd.concat([report, total])
+    report['saving_%'] = (100 * (1 - report['after_bytes'] / report['before_bytes'])).round(1)
+    return report
+
+# Creating a function to make a new, uniquely named scratch folder next to path to write a folder export into
+# Being in the same parent folder means it can be renamed into place, and a unique name means no existing folder is ever reused or deleted
+def make_scratch_folder(path):
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f'.{os.path.basename(os.path.abspath(path))}.tmp-', dir=parent)
+
+# Creating a function to swap a finished scratch folder into place, moving any old folder at path into its own
+# uniquely named scratch folder first and only deleting that scratch folder once the swap has been made
+def replace_folder(scratch_path, path):
+    old_scratch = None
+    if os.path.exists(path):
+        old_scratch = make_scratch_folder(path)
+        os.replace(path, os.path.join(old_scratch, 'old'))
+    os.replace(scratch_path, path)
+    if old_scratch is not None:
+        shutil.rmtree(old_scratch)
+
+# Creating a context manager for writing a file atomically: the caller writes to the temporary path it is given,
+# which only replaces the real file once writing has finished, so a crash never leaves a half-written file behind
+@contextmanager
+def atomic_write(path):
+    # the temporary file goes in its own scratch folder next to path, so no existing file is ever overwritten or deleted
+    scratch_path = make_scratch_folder(path)
+    temp_path = os.path.join(scratch_path, os.path.basename(path))
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        shutil.rmtree(scratch_path, ignore_errors=True)
+
+# File extensions added after .csv for each compression codec export_to_csv supports
+csv_extensions = {None: '', 'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+
+# Name of the marker file export_to_parquet_dataset writes into each dataset folder
+# pyarrow skips files starting with an underscore, so it isn't mistaken for data when the dataset is read
+dataset_marker = '_loan_dataset.yaml'
+
+# Creating a function to open a file for writing with one of the compression codecs in csv_extensions
+def open_compressed(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.open(path, 'wb', cctx=zstandard.ZstdCompressor(threads=-1))
+    if compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.open(path, 'wb')
+    return open(path, 'wb')
+
+# Creating a context manager to open a csv for reading, decompressing .lz4 files through lz4.frame since pandas can't read them
+# Other paths are passed through unchanged for pandas, pyarrow and polars to open (and decompress .gz/.zst) themselves
+@contextmanager
+def open_csv(path):
+    if not str(path).endswith('.lz4'):
+        yield f'{path}'
+        return
+    import lz4.frame
+    with lz4.frame.open(path, 'rb') as file:
+        yield file
+
+# Creating a function to read just the column names of a csv
+def csv_header(path):
+    with open_csv(path) as source:
+        return pd.read_csv(source, nrows=0).columns
+
+# Creating a function to tell whether a csv starts with an unnamed index column, as written by to_csv or export_to_csv(index=True)
+# pandas names an empty header 'Unnamed: 0', files written with index=False start straight with a real column such as id
+def has_index_column(header):
+    return len(header) > 0 and (header[0] == '' or str(header[0]).startswith('Unnamed'))
+
+# Creating a function to turn a block of rows into csv bytes, compressed as a complete gzip member or lz4 frame
+# Complete members and frames can simply be written one after another and still decompress as a single file
+# zstd blocks are left uncompressed here because pandas only reads the first frame of a .zst file,
+# so export_to_csv streams them through one multithreaded zstd compressor instead
+# This is a module level function so that it can be sent to worker processes
+def format_csv_block(block, header, index, compression):
+    data = block.to_csv(header=header, index=index).encode('utf-8')
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(data)
+    return data
+
+# Creating a function to quote a table or column name for SQL written by hand, doubling any quotes inside it
+def quote_identifier(name):
+    escaped = name.replace('"', '""')
+    return f'"{escaped}"'
+
+# Engines are shared by every connector in the process that uses the same credentials and pool settings,
+# so new connectors reuse warm pooled connections instead of paying for a fresh TCP/TLS/login handshake each time
+_engines = {}
+_engines_lock = threading.Lock()
+
+# Creating a function to get the shared engine for a set of credentials, creating it on first use
+# pool_size connections are kept open, up to max_overflow more are opened under load,
+# pool_pre_ping checks a connection is still alive before handing it out and pool_recycle replaces connections older than that many seconds
+def get_engine(creds, pool_size=5, max_overflow=10, pool_pre_ping=True, pool_recycle=1800):
+    from sqlalchemy import create_engine
+    url = f"postgresql+psycopg2://{creds['RDS_USER']}:{creds['RDS_PASSWORD']}@{creds['RDS_HOST']}:{creds['RDS_PORT']}/{creds['RDS_DATABASE']}"
+    key = (url, pool_size, max_overflow, pool_pre_ping, pool_recycle)
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = create_engine(
+                url,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_pre_ping=pool_pre_ping,
+                pool_recycle=pool_recycle,
+            )
+        return _engines[key]
+
+# Creating a function to report how busy each shared engine's connection pool is, for monitoring
+def pool_statistics():
+    with _engines_lock:
+        engines = list(_engines.values())
+    stats = []
+    for engine in engines:
+        pool = engine.pool
+        stats.append({
+            'url': engine.url.render_as_string(hide_password=True),
+            'pool_size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        })
+    return pd.DataFrame(stats)
+
+# Creating a function to close every pooled connection, e.g. before forking worker processes
+def dispose_engines():
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+# Creating a class for a small quantile sketch (a simplified t-digest) so quantiles can be estimated without keeping every value
+# Values are kept as weighted centroids, and once there are more than compression of them neighbouring centroids are merged,
+# keeping them small near the tails (where quantiles need to be accurate) and larger in the middle
+class QuantileSketch:
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+
+    def update(self, values):
+        values = np.asarray(values, dtype='float64')
+        self.add(values, np.ones(len(values)))
+
+    def merge(self, other):
+        self.add(other.means, other.weights)
+
+    def add(self, means, weights):
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        if len(means) > self.compression:
+            # mapping each centroid's position through the arcsine scale function and merging those that land in the same bucket
+            positions = (np.cumsum(weights) - weights / 2) / weights.sum()
+            buckets = np.floor(self.compression * (np.arcsin(2 * positions - 1) / np.pi + 0.5)).astype('int64')
+            totals = np.bincount(buckets, weights=weights)
+            sums = np.bincount(buckets, weights=means * weights)
+            keep = totals > 0
+            means, weights = sums[keep] / totals[keep], totals[keep]
+        self.means, self.weights = means, weights
+
+    def quantile(self, q):
+        if len(self.weights) == 0:
+            return np.nan
+        positions = (np.cumsum(self.weights) - self.weights / 2) / self.weights.sum()
+        return float(np.interp(q, positions, self.means))
+
+# Creating a class for a HyperLogLog sketch, which estimates how many distinct values a column has using a fixed amount of memory
+# Each value is hashed, the first precision bits of the hash pick a register and the register keeps the longest run of leading zeros
+# seen in the rest of the hash; two sketches merge by taking the larger of each register. The typical error is 1.04 / sqrt(2 ** precision)
+class HyperLogLog:
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype='uint8')
+
+    def update(self, series):
+        series = series.dropna()
+        if series.empty:
+            return
+        hashes = pd.util.hash_pandas_object(series, index=False).to_numpy()
+        registers = (hashes >> np.uint64(64 - self.precision)).astype('int64')
+        remainder = hashes << np.uint64(self.precision)
+        with np.errstate(divide='ignore'):
+            bit_length = np.where(remainder == 0, 0, np.floor(np.log2(remainder.astype('float64'))) + 1)
+        ranks = np.minimum(65 - bit_length, 65 - self.precision).astype('uint8')
+        # keeping the highest rank seen for each register in this chunk, then combining with the existing registers
+        highest = pd.Series(ranks).groupby(registers).max()
+        positions = highest.index.to_numpy()
+        self.registers[positions] = np.maximum(self.registers[positions], highest.to_numpy())
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(2.0 ** -self.registers.astype('float64'))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # small cardinalities are estimated more accurately from the number of empty registers
+        if raw <= 2.5 * m and zeros:
+            return m * np.log(m / zeros)
+        return raw
+
+# Creating a class to build up summary statistics for one column a chunk at a time
+# Numeric columns track the count, mean and variance (combined between chunks with Chan's parallel formula), min, max and a quantile sketch,
+# other columns track value counts, so the memory used depends on the number of distinct categories rather than the number of rows
+# Every column also has a HyperLogLog sketch of its distinct values
+# Profiles of different chunks of the same column can be combined with merge, so chunks can be profiled on separate workers
+class ColumnProfile:
+    def __init__(self, name):
+        self.name = name
+        self.numeric = None
+        self.count = 0
+        self.nulls = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = np.nan
+        self.maximum = np.nan
+        self.sketch = QuantileSketch()
+        self.distinct = HyperLogLog()
+        self.value_counts = pd.Series(dtype='int64')
+
+    # Chunks built from database rows can hold numbers as plain Python objects (e.g. Decimal for NUMERIC columns, or
+    # an object column of None when a chunk happens to be all null), so object columns are converted to numbers where possible
+    # and whether the column is numeric is only decided from the first chunk that has any values
+    def update(self, series):
+        if series.dtype == object:
+            series = series.infer_objects()
+            if series.dtype == object and self.numeric is not False:
+                try:
+                    series = pd.to_numeric(series)
+                except (ValueError, TypeError):
+                    pass
+        if self.numeric is None and series.notna().any():
+            self.numeric = pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+        self.nulls += int(series.isna().sum())
+        # numbers are hashed as floats so 5 and 5.0 from differently typed chunks count as the same value
+        self.distinct.update(series.astype('float64') if self.numeric else series)
+        if self.numeric is None:
+            return
+        if self.numeric:
+            values = series.dropna().to_numpy(dtype='float64')
+            if len(values):
+                chunk = ColumnProfile(self.name)
+                chunk.numeric = True
+                chunk.count = len(values)
+                chunk.mean = values.mean()
+                chunk.m2 = ((values - chunk.mean) ** 2).sum()
+                chunk.minimum, chunk.maximum = values.min(), values.max()
+                chunk.sketch.update(values)
+                self.merge(chunk, nulls=False)
+        else:
+            counts = series.value_counts(dropna=True)
+            # categorical columns also list categories that don't appear in this chunk, with a count of 0
+            counts = counts[counts > 0]
+            counts.index = counts.index.astype(object)
+            self.value_counts = self.value_counts.add(counts, fill_value=0).astype('int64')
+            self.count += int(counts.sum())
+
+    # Combining another profile of the same column, e.g. one built from a different chunk of rows
+    def merge(self, other, nulls=True):
+        if self.numeric is None:
+            self.numeric = other.numeric
+        if nulls:
+            self.nulls += other.nulls
+            self.distinct.merge(other.distinct)
+        if self.numeric:
+            count = self.count + other.count
+            if other.count:
+                delta = other.mean - self.mean
+                self.mean += delta * other.count / count
+                self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+                self.minimum = np.fmin(self.minimum, other.minimum)
+                self.maximum = np.fmax(self.maximum, other.maximum)
+                self.sketch.merge(other.sketch)
+            self.count = count
+        else:
+            self.count += other.count
+            self.value_counts = self.value_counts.add(other.value_counts, fill_value=0).astype('int64')
+
+    def summary(self):
+        rows = self.count + self.nulls
+        result = {
+            'count': self.count,
+            'nulls': self.nulls,
+            'null_%': round(100 * self.nulls / rows, 2) if rows else np.nan,
+            'distinct': int(round(self.distinct.estimate())),
+        }
+        if self.numeric:
+            result.update({
+                'mean': self.mean if self.count else np.nan,
+                'std': np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan,
+                'min': self.minimum,
+                '25%': self.sketch.quantile(0.25),
+                '50%': self.sketch.quantile(0.5),
+                '75%': self.sketch.quantile(0.75),
+                'max': self.maximum,
+            })
+        else:
+            result.update({
+                'unique': len(self.value_counts),
+                'top': self.value_counts.idxmax() if len(self.value_counts) else np.nan,
+                'freq': int(self.value_counts.max()) if len(self.value_counts) else np.nan,
+            })
+        return result
+
+# Creating a class to build up a ColumnProfile for every column of a table, one chunk of rows at a time
+class TableProfile:
+    def __init__(self):
+        self.columns = {}
+
+    # df can be a pandas or Polars dataframe
+    def update(self, df):
+        df = as_pandas(df)
+        for column in df.columns:
+            if column not in self.columns:
+                self.columns[column] = ColumnProfile(column)
+            self.columns[column].update(df[column])
+
+    def merge(self, other):
+        for column, profile in other.columns.items():
+            if column in self.columns:
+                self.columns[column].merge(profile)
+            else:
+                self.columns[column] = profile
+
+    # One row per column, like df.describe(include='all') plus null counts
+    def summary(self):
+        return pd.DataFrame({column: profile.summary() for column, profile in self.columns.items()}).T
+
+    def value_counts(self, column):
+        return self.columns[column].value_counts.sort_values(ascending=False)
+
+# Creating a function to profile one chunk, at module level so it can be sent to worker processes
+def profile_chunk(df):
+    chunk_profile = TableProfile()
+    chunk_profile.update(df)
+    return chunk_profile
+
+# Creating a function to profile a table in one pass over a stream of dataframe chunks, without ever holding the whole table
+# chunks can be anything that yields pandas or Polars dataframes, e.g. RDSDatabaseConnector.stream_data or pd.read_csv(..., chunksize=...)
+# workers profiles that many chunks at once on separate processes and merges the results, keeping at most two chunks per worker in flight
+def profile(chunks, workers=None):
+    result = TableProfile()
+    if not workers:
+        for chunk in chunks:
+            result.update(chunk)
+        return result
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(profile_chunk, as_pandas(chunk)))
+            if len(pending) >= 2 * workers:
+                result.merge(pending.popleft().result())
+        while pending:
+            result.merge(pending.popleft().result())
+    return result
+
+# Creating a class to keep local Parquet snapshots of database tables
+# Each snapshot is stored with the fingerprint the table had when it was downloaded, so it is only reused while the table is unchanged
+# When the snapshots take up more than max_bytes the least recently used ones are deleted
+class TableCache:
+    def __init__(self, cache_dir='cache', max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.yaml')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        return load_yaml(self.index_path) or {}
+
+    def save_index(self, index):
+        # writing to a temporary file first means a crash can never leave a half-written index behind
+        temp_path = f'{self.index_path}.tmp'
+        with open(temp_path, 'w') as file:
+            yaml.safe_dump(index, file)
+        os.replace(temp_path, self.index_path)
+
+    # Snapshots are kept per source (the server and database they came from, e.g. 'host:5432/database') as well as per table,
+    # so connectors pointed at different databases never share a snapshot of tables that happen to have the same name
+    def cache_key(self, source, table_name):
+        return f'{source}/{table_name}'
+
+    def snapshot_path(self, key):
+        # making a safe file name from the key, with a short hash on the end so different keys can't end up with the same name
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:10]
+        return os.path.join(self.cache_dir, f'{safe_name}-{digest}.parquet')
+
+    # Returns the cached dataframe, or None if there is no snapshot or the table has changed since it was taken
+    def get(self, source, table_name, fingerprint):
+        index = self.load_index()
+        key = self.cache_key(source, table_name)
+        entry = index.get(key)
+        path = self.snapshot_path(key)
+        if entry is None or entry['fingerprint'] != fingerprint or not os.path.exists(path):
+            return None
+        entry['last_used'] = time.time()
+        self.save_index(index)
+        return pd.read_parquet(path)
+
+    def put(self, source, table_name, fingerprint, df):
+        key = self.cache_key(source, table_name)
+        path = self.snapshot_path(key)
+        df.to_parquet(path, engine='pyarrow')
+        index = self.load_index()
+        index[key] = {
+            'source': source,
+            'table_name': table_name,
+            'fingerprint': fingerprint,
+            'bytes': os.path.getsize(path),
+            'last_used': time.time(),
+        }
+        self.evict(index)
+        self.save_index(index)
+
+    # Deleting the least recently used snapshots until the cache fits inside max_bytes
+    def evict(self, index):
+        total = sum(entry['bytes'] for entry in index.values())
+        for key in sorted(index, key=lambda name: index[name]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= index[key]['bytes']
+            self.remove_snapshot(key)
+            del index[key]
+
+    def remove_snapshot(self, key):
+        path = self.snapshot_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    # Removes the snapshots of one table (from every source, or just the given one), or every snapshot if no table name is given
+    def invalidate(self, table_name=None, source=None):
+        index = self.load_index()
+        for key, entry in list(index.items()):
+            if table_name is not None and entry.get('table_name') != table_name:
+                continue
+            if source is not None and entry.get('source') != source:
+                continue
+            self.remove_snapshot(key)
+            del index[key]
+        self.save_index(index)
+
+    def size(self):
+        return sum(entry['bytes'] for entry in self.load_index().values())
 
 # Creating a class to extract data from RDS database
 class RDSDatabaseConnector:
-    def __init__(self, creds):
+    # creds can be left out, in which case they are loaded with load_credentials when first needed
+    # backend chooses what get_data, read_csv and read_parquet return: 'pandas', a Polars DataFrame ('polars'),
+    # or a Polars LazyFrame ('polars-lazy') that only runs when .collect() is called
+    # self.df is always kept as a pandas dataframe so the export methods work whichever backend is chosen
+    def __init__(self, creds=None, backend='pandas'):
+        if backend not in backends:
+            raise ValueError(f'backend must be one of {backends}')
         self.creds = creds
+        self.backend = backend
+        self.lookup_indexes = {}
+
+    # Creating a method to convert a pandas dataframe to the chosen backend
+    def to_backend(self, df, backend=None):
+        backend = backend or self.backend
+        if backend == 'pandas':
+            return df
+        import polars as pl
+        df = pl.from_pandas(df, include_index=False)
+        return df.lazy() if backend == 'polars-lazy' else df
+
+    def get_creds(self):
+        if self.creds is None:
+            self.creds = load_credentials()
+        return self.creds
+
+    # Any keyword arguments are passed on to get_engine to configure the shared connection pool
+    def start_sqlalchemy_engine(self, **pool_options):
+        self.engine = get_engine(self.get_creds(), **pool_options)
+
+    # columns only selects the named columns and filters only selects matching rows, both are done by the database
+    # so only the rows and columns that are needed are sent over the network
+    # filters is a list of (column, operator, value) conditions that must all be true, in the same style as read_parquet, e.g.
+    # [('loan_status', 'in', ['Charged Off', 'Default']), ('issue_date', 'between', ('2020-01-01', '2020-12-01'))]
+    # partitions splits the table into that many id ranges which are fetched at the same time on a thread pool,
+    # each over its own pooled connection, and then joined back together in id order
+    # Threads are used rather than processes because the engine can't be shared across processes and the drivers release the GIL while waiting
+    # sample returns roughly that fraction of the rows (0 < sample <= 1) for quick exploration, using TABLESAMPLE
+    # sample_method 'bernoulli' picks individual rows, 'system' picks whole disk pages which is faster but clumpier
+    # stratify_by instead takes exactly that fraction of every group in the named column (e.g. 'loan_status' or 'grade'),
+    # seed makes either kind of sample repeatable, and the sampling settings are stored in df.attrs so statistics can be scaled back up
+    def get_data(self, table_name, columns=None, filters=None, partitions=None, sample=None, sample_method='bernoulli', stratify_by=None, seed=0):
+        if sample is None and stratify_by is not None:
+            raise ValueError('stratify_by needs a sample fraction, e.g. sample=0.1')
+        sampling = {'sample': sample, 'sample_method': sample_method, 'stratify_by': stratify_by, 'seed': seed}
+        if partitions is not None and partitions > 1:
+            self.df = self.get_data_partitioned(table_name, partitions, columns, filters, **sampling)
+        elif columns is None and filters is None and sample is None:
+            self.df = pd.read_sql_table(f'{table_name}', self.engine)
+        else:
+            query, params = self.build_query(table_name, columns, filters, **sampling)
+            self.df = self.read_query(query, params)
+        if sample is not None:
+            self.df.attrs['sample_fraction'] = sample
+            self.df.attrs['sample_method'] = 'stratified' if stratify_by is not None else sample_method
+            self.df.attrs['stratify_by'] = stratify_by
+            self.df.attrs['sample_seed'] = seed
+        return self.to_backend(self.df)
+
+    # Running a query from build_query, dropping the helper columns used for stratified sampling
+    def read_query(self, query, params):
+        df = pd.read_sql(query, self.engine, params=params)
+        return df.drop(columns=['_sample_row', '_stratum_rows'], errors='ignore')
+
+    # Creating a method to compile columns, filters and sampling into a parameterised SELECT statement
+    def build_query(self, table_name, columns=None, filters=None, sample=None, sample_method='bernoulli', stratify_by=None, seed=0):
+        quote = self.engine.dialect.identifier_preparer.quote
+        select = '*' if columns is None else ', '.join(quote(column) for column in columns)
+        if sample is None:
+            return self.compile_statement(f'SELECT {select} FROM {quote(table_name)}', filters)
+        if not 0 < sample <= 1:
+            raise ValueError('sample must be a fraction between 0 and 1')
+        if stratify_by is not None:
+            # ranking the rows of each group in a shuffled but repeatable order and keeping the first sample fraction of them
+            stratum = quote(stratify_by)
+            inner = (
+                f'SELECT *, ROW_NUMBER() OVER (PARTITION BY {stratum} ORDER BY md5(id::text || :sample_seed)) AS _sample_row, '
+                f'COUNT(*) OVER (PARTITION BY {stratum}) AS _stratum_rows FROM {quote(table_name)}'
+            )
+            prefix = 'SELECT * FROM (' if columns is None else f'SELECT {select}, _sample_row, _stratum_rows FROM ('
+            suffix = ') AS sampled WHERE _sample_row <= CEIL(_stratum_rows * :sample_fraction)'
+            statement, params = self.compile_statement(inner, filters, suffix, prefix)
+            params.update({'sample_seed': str(seed), 'sample_fraction': sample})
+            return statement, params
+        if sample_method.lower() not in ('bernoulli', 'system'):
+            raise ValueError("sample_method must be 'bernoulli' or 'system'")
+        table = f'{quote(table_name)} TABLESAMPLE {sample_method.upper()} (:sample_percent) REPEATABLE (:sample_seed)'
+        statement, params = self.compile_statement(f'SELECT {select} FROM {table}', filters)
+        params.update({'sample_percent': sample * 100, 'sample_seed': seed})
+        return statement, params
+
+    # Creating a method to add the WHERE clause for a list of filters onto a statement
+    # Values are always sent as bound parameters and names are quoted, so nothing from the filters is pasted into the SQL
+    # Range comparisons on the month-year text columns are made on to_date(column, 'Mon-YYYY') so they compare as dates
+    def compile_statement(self, query, filters=None, suffix='', prefix=''):
+        from sqlalchemy import bindparam, text
+        quote = self.engine.dialect.identifier_preparer.quote
+        conditions = []
+        params = {}
+        expanding = []
+        for number, condition in enumerate(filters or []):
+            column, operator = condition[0], condition[1].lower()
+            value = condition[2] if len(condition) > 2 else None
+            name = f'p{number}'
+            target = quote(column)
+            if column in month_year_columns and operator in ('<', '<=', '>', '>=', 'between'):
+                target = f"to_date({target}, 'Mon-YYYY')"
+                value = [pd.Timestamp(item).date() for item in value] if operator == 'between' else pd.Timestamp(value).date()
+            if operator in ('==', '!=', '<', '<=', '>', '>='):
+                sql_operator = {'==': '=', '!=': '<>'}.get(operator, operator)
+                conditions.append(f'{target} {sql_operator} :{name}')
+                params[name] = value
+            elif operator in ('in', 'not in'):
+                conditions.append(f'{target} {operator.upper()} :{name}')
+                params[name] = list(value)
+                expanding.append(name)
+            elif operator == 'between':
+                low, high = value
+                conditions.append(f'{target} BETWEEN :{name}_low AND :{name}_high')
+                params[f'{name}_low'], params[f'{name}_high'] = low, high
+            elif operator == 'is null':
+                conditions.append(f'{target} IS NULL')
+            elif operator == 'not null':
+                conditions.append(f'{target} IS NOT NULL')
+            else:
+                raise ValueError(f"Unsupported filter operator '{condition[1]}'")
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        statement = text(prefix + query + suffix)
+        if expanding:
+            statement = statement.bindparams(*[bindparam(name, expanding=True) for name in expanding])
+        return statement, params
+
+    # Creating a method to get grouped totals calculated by the database, so only the small result table is transferred
+    # aggregations maps column names to a function name or list of function names, like pandas' agg, e.g.
+    # aggregate('loan_payments', ['grade'], {'loan_amount': 'sum', 'int_rate': ['mean', 'max'], 'id': 'count'})
+    # The result has one row per group and columns named like loan_amount_sum, and filters work the same as in get_data
+    def aggregate(self, table_name, group_by, aggregations, filters=None):
+        sql_functions = {
+            'sum': 'SUM({})',
+            'mean': 'AVG({})',
+            'min': 'MIN({})',
+            'max': 'MAX({})',
+            'count': 'COUNT({})',
+            'nunique': 'COUNT(DISTINCT {})',
+            'std': 'STDDEV_SAMP({})',
+            'var': 'VAR_SAMP({})',
+        }
+        quote = self.engine.dialect.identifier_preparer.quote
+        if isinstance(group_by, str):
+            group_by = [group_by]
+        selected = [quote(column) for column in group_by]
+        for column, functions in aggregations.items():
+            for function in [functions] if isinstance(functions, str) else functions:
+                if function not in sql_functions:
+                    raise ValueError(f"Unsupported aggregation '{function}', choose from {list(sql_functions)}")
+                selected.append(f'{sql_functions[function].format(quote(column))} AS {quote(f"{column}_{function}")}')
+        query = f'SELECT {", ".join(selected)} FROM {quote(table_name)}'
+        suffix = ''
+        if group_by:
+            keys = ', '.join(quote(column) for column in group_by)
+            suffix = f' GROUP BY {keys} ORDER BY {keys}'
+        statement, params = self.compile_statement(query, filters, suffix)
+        return pd.read_sql(statement, self.engine, params=params)
+
+    def get_data_partitioned(self, table_name, partitions, columns=None, filters=None, **sampling):
+        from sqlalchemy import text
+        table = self.engine.dialect.identifier_preparer.quote(table_name)
+        with self.engine.connect() as connection:
+            min_id, max_id = connection.execute(text(f'SELECT MIN(id), MAX(id) FROM {table}')).fetchone()
+        if min_id is None:
+            query, params = self.build_query(table_name, columns, filters, **sampling)
+            return self.read_query(query, params)
+        # splitting min_id..max_id into equal ranges, the last range ends one past max_id so it includes it
+        step = max((max_id - min_id + 1) // partitions, 1)
+        bounds = list(range(min_id, max_id + 1, step))[:partitions] + [max_id + 1]
+
+        def fetch(low, high):
+            id_range = [('id', '>=', low), ('id', '<', high)]
+            query, params = self.build_query(table_name, columns, list(filters or []) + id_range, **sampling)
+            return self.read_query(query, params)
+
+        # never running more slices at once than the pool can hand out connections for, otherwise the extra threads
+        # wait on the pool and can time out; the remaining slices queue up in the thread pool instead
+        workers = len(bounds) - 1
+        pool = self.engine.pool
+        max_overflow = getattr(pool, '_max_overflow', -1)
+        if hasattr(pool, 'size') and max_overflow >= 0:
+            workers = max(1, min(workers, pool.size() + max_overflow))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(fetch, bounds[:-1], bounds[1:]))
+        return pd.concat(chunks, ignore_index=True)
+
+    # Creating a method to get a cheap fingerprint of a table that changes whenever rows are inserted, updated or deleted
+    # The counters in pg_stat_user_tables are used so the table itself doesn't have to be scanned,
+    # falling back to the row count and largest id if the statistics aren't available
+    def table_fingerprint(self, table_name):
+        from sqlalchemy import text
+        table = self.engine.dialect.identifier_preparer.quote(table_name)
+        with self.engine.connect() as connection:
+            # to_regclass resolves the name through the search path, so a table with the same name in another schema isn't picked up
+            stats = connection.execute(
+                text('SELECT n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables WHERE relid = to_regclass(CAST(:table_name AS text))'),
+                {'table_name': table},
+            ).fetchone()
+            if stats is not None:
+                return [int(value) for value in stats]
+            row_count, max_id = connection.execute(text(f'SELECT COUNT(*), MAX(id) FROM {table}')).fetchone()
+        return [int(row_count), None if max_id is None else int(max_id)]
+
+    # Creating a method to name the server and database this connector reads from, used to keep cached snapshots apart
+    def cache_source(self):
+        creds = self.get_creds()
+        return f"{creds['RDS_HOST']}:{creds['RDS_PORT']}/{creds['RDS_DATABASE']}"
+
+    # Creating a method to load a table from the local cache, only going to the database when the table has changed
+    def get_data_cached(self, table_name, cache):
+        source = self.cache_source()
+        fingerprint = self.table_fingerprint(table_name)
+        df = cache.get(source, table_name, fingerprint)
+        if df is None:
+            self.get_data(table_name)
+            df = self.df
+            cache.put(source, table_name, fingerprint, df)
+        self.df = df
+        return self.to_backend(self.df)
+
+    # Creating a method to bring a local snapshot (.csv or .parquet) up to date without downloading the whole table again
+    # The high-water marks are read from the snapshot itself: rows with an id above the largest local id are new loans,
+    # and rows paid in or after the latest local last_payment_date month are re-fetched as possibly updated
+    # As last_payment_date is only a month, every row paid in that month is re-fetched on each sync even if it hasn't changed
+    # (about 29% of the sample data), so the re-fetched rows are compared with the snapshot and only the ones that differ are replaced
+    # Returns the number of rows inserted, updated (re-fetched and different) and re-fetched in total
+    # Like get_data, this needs start_sqlalchemy_engine to have been called first
+    def sync_data(self, table_name, snapshot_path):
+        from sqlalchemy import text
+        is_csv = snapshot_path.endswith('.csv')
+        if not os.path.exists(snapshot_path):
+            self.get_data(table_name)
+            self.save_snapshot(snapshot_path, is_csv)
+            return {'inserted': len(self.df), 'updated': 0, 'refetched': 0}
+        snapshot = self.read_csv(snapshot_path, backend='pandas') if is_csv else pd.read_parquet(snapshot_path)
+        max_id = int(snapshot['id'].max())
+        last_payment = parse_month_year(snapshot['last_payment_date']).max()
+        since = None if pd.isna(last_payment) else last_payment.date()
+        table = self.engine.dialect.identifier_preparer.quote(table_name)
+        query = text(
+            f"SELECT * FROM {table} WHERE id > :max_id OR to_date(last_payment_date, 'Mon-YYYY') >= CAST(:since AS date)"
+        )
+        changed = pd.read_sql(query, self.engine, params={'max_id': max_id, 'since': since})
+        # putting the snapshot's dtypes back, letting categoricals pick up any new categories
+        dtypes = {column: 'category' if isinstance(dtype, pd.CategoricalDtype) else dtype for column, dtype in snapshot.dtypes.items()}
+        fetched = changed.astype({column: dtype for column, dtype in dtypes.items() if column in changed.columns})
+        is_new = ~fetched['id'].isin(snapshot['id'])
+        refetched = fetched[~is_new].set_index('id')
+        previous = snapshot[snapshot['id'].isin(refetched.index)].set_index('id').reindex(index=refetched.index, columns=refetched.columns)
+        # comparing as plain objects with missing values swapped for a marker, so NaN == NaN and differing categories don't matter
+        missing = object()
+        same = previous.astype(object).fillna(missing) == refetched.astype(object).fillna(missing)
+        modified = refetched.index[~same.all(axis=1)]
+        combined = pd.concat([snapshot[~snapshot['id'].isin(modified)], fetched[is_new | fetched['id'].isin(modified)]], ignore_index=True)
+        self.df = combined.astype(dtypes)
+        self.save_snapshot(snapshot_path, is_csv)
+        return {'inserted': int(is_new.sum()), 'updated': len(modified), 'refetched': len(refetched)}
 
-    def start_sqlalchemy_engine(self):
-        self.engine = create_engine(f"postgresql+psycopg2://{self.creds['RDS_USER']}:{self.creds['RDS_PASSWORD']}@{self.creds['RDS_HOST']}:{self.creds['RDS_PORT']}/{self.creds['RDS_DATABASE']}")
+    def save_snapshot(self, snapshot_path, is_csv):
+        with atomic_write(snapshot_path) as temp_path:
+            if is_csv:
+                self.df.to_csv(temp_path)
+            else:
+                self.df.to_parquet(temp_path, engine='pyarrow')
 
-    def get_data(self, table_name):
-        self.df = pd.read_sql_table(f'{table_name}', self.engine)
+    # Creating a method to open a plain psycopg2 connection using the same credentials as the engine
+    def connect_psycopg2(self):
+        import psycopg2
+        creds = self.get_creds()
+        connection = psycopg2.connect(
+            host=creds['RDS_HOST'],
+            port=creds['RDS_PORT'],
+            dbname=creds['RDS_DATABASE'],
+            user=creds['RDS_USER'],
+            password=creds['RDS_PASSWORD'],
+        )
+        return connection
+
+    # Creating a method to stream a table in chunks instead of loading it all at once
+    # A named (server-side) cursor keeps the rows on the server, so only chunk_size rows are held in memory at a time
+    def stream_data(self, table_name, chunk_size=10000):
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be a positive number of rows')
+        from psycopg2 import sql
+        connection = self.connect_psycopg2()
+        try:
+            # server-side cursors only live inside a transaction, which psycopg2 opens for us
+            with connection.cursor(name=f'stream_{table_name}') as cursor:
+                cursor.itersize = chunk_size
+                cursor.execute(sql.SQL('SELECT * FROM {}').format(sql.Identifier(table_name)))
+                columns = None
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if columns is None:
+                        columns = [column[0] for column in cursor.description]
+                    if not rows:
+                        break
+                    yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        finally:
+            connection.close()
+
+    # Creating a method to extract a whole table with PostgreSQL COPY, which is much faster than fetching row by row
+    # The server writes the table as CSV text and pandas parses that buffer in one go
+    def copy_data(self, table_name):
+        from psycopg2 import sql
+        connection = self.connect_psycopg2()
+        try:
+            buffer = io.BytesIO()
+            with connection.cursor() as cursor:
+                query = sql.SQL('COPY (SELECT * FROM {}) TO STDOUT WITH (FORMAT CSV, HEADER TRUE)').format(sql.Identifier(table_name))
+                cursor.copy_expert(query.as_string(connection), buffer)
+        finally:
+            connection.close()
+        buffer.seek(0)
+        self.df = pd.read_csv(buffer)
         return self.df
 
-    def export_to_csv(self, path):
-        self.df.to_csv(f'{path}.csv')
+    # Creating async counterparts of get_data using the asyncpg driver, so several tables can be downloaded at once
+    # while one process waits on all of their queries, e.g. asyncio.run(test.get_tables_async(['loan_payments', 'members']))
+    async def connect_async(self):
+        import asyncpg
+        creds = self.get_creds()
+        return await asyncpg.connect(
+            host=creds['RDS_HOST'],
+            port=int(creds['RDS_PORT']),
+            database=creds['RDS_DATABASE'],
+            user=creds['RDS_USER'],
+            password=creds['RDS_PASSWORD'],
+        )
+
+    # Rows are read through a cursor chunk_size at a time and their values appended straight onto one list per column,
+    # so the finished dataframe is built from columns rather than from a list of row records
+    # pool can be an asyncpg pool to take a connection from, otherwise a new connection is opened and closed
+    async def get_data_async(self, table_name, columns=None, chunk_size=10000, pool=None):
+        connection = await pool.acquire() if pool is not None else await self.connect_async()
+        try:
+            select = '*' if columns is None else ', '.join(quote_identifier(column) for column in columns)
+            async with connection.transaction():
+                statement = await connection.prepare(f'SELECT {select} FROM {quote_identifier(table_name)}')
+                names = [attribute.name for attribute in statement.get_attributes()]
+                buffers = [[] for _ in names]
+                cursor = await statement.cursor()
+                while True:
+                    records = await cursor.fetch(chunk_size)
+                    if not records:
+                        break
+                    for position, buffer in enumerate(buffers):
+                        buffer.extend(record[position] for record in records)
+        finally:
+            if pool is not None:
+                await pool.release(connection)
+            else:
+                await connection.close()
+        return pd.DataFrame(dict(zip(names, buffers)), columns=names)
+
+    # Downloads several tables concurrently over a shared pool and returns a dictionary of table name to dataframe
+    async def get_tables_async(self, table_names, chunk_size=10000, max_connections=10):
+        import asyncio
+        import asyncpg
+        creds = self.get_creds()
+        async with asyncpg.create_pool(
+            host=creds['RDS_HOST'],
+            port=int(creds['RDS_PORT']),
+            database=creds['RDS_DATABASE'],
+            user=creds['RDS_USER'],
+            password=creds['RDS_PASSWORD'],
+            min_size=1,
+            max_size=max(1, min(max_connections, len(table_names))),
+        ) as pool:
+            frames = await asyncio.gather(*[self.get_data_async(name, chunk_size=chunk_size, pool=pool) for name in table_names])
+        return dict(zip(table_names, frames))
+
+    # compression can be None, 'gzip', 'zstd' or 'lz4', and adds .gz, .zst or .lz4 after .csv
+    # pandas itself can't read .lz4 files, but read_csv and summarise_csv in this class decompress them
+    # index=False leaves out the dataframe's integer index
+    # The rows are formatted and compressed block_rows at a time and written out as they are ready,
+    # parallel=True does the formatting and compressing of the blocks on several processes and still writes them in order,
+    # keeping at most two blocks per worker in flight so the whole file is never held in memory at once
+    def export_to_csv(self, path, compression=None, index=True, parallel=False, max_workers=None, block_rows=50000):
+        if compression not in csv_extensions:
+            raise ValueError(f'compression must be one of {list(csv_extensions)}')
+        starts = range(0, len(self.df), block_rows) if len(self.df) else [0]
+        blocks = (self.df.iloc[start:start + block_rows] for start in starts)
+        headers = (start == 0 for start in starts)
+        with atomic_write(f'{path}.csv{csv_extensions[compression]}') as temp_path, open(temp_path, 'wb') as file:
+            if compression == 'zstd':
+                import zstandard
+                writer = zstandard.ZstdCompressor(threads=-1).stream_writer(file, closefd=False)
+            else:
+                writer = file
+            if parallel:
+                workers = max_workers or os.cpu_count() or 1
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    pending = deque()
+                    for block, header in zip(blocks, headers):
+                        pending.append(executor.submit(format_csv_block, block, header, index, compression))
+                        if len(pending) >= 2 * workers:
+                            writer.write(pending.popleft().result())
+                    while pending:
+                        writer.write(pending.popleft().result())
+            else:
+                for piece in map(format_csv_block, blocks, headers, repeat(index), repeat(compression)):
+                    writer.write(piece)
+            if writer is not file:
+                writer.close()
+
+    # Creating a method to export a whole database table to csv chunk_size rows at a time, which can pick up where it left off
+    # Chunks are fetched in id order and each finished chunk is saved in path.parts/ and recorded in a manifest,
+    # so if the export is interrupted, running it again carries on after the last finished chunk instead of starting over
+    # Once every chunk is done they are joined into the final file (compressed the same way as export_to_csv) and the parts are deleted
+    def export_table_to_csv(self, table_name, path, chunk_size=100000, compression=None):
+        if compression not in csv_extensions:
+            raise ValueError(f'compression must be one of {list(csv_extensions)}')
+        parts_dir = f'{path}.parts'
+        manifest_path = os.path.join(parts_dir, 'manifest.yaml')
+        os.makedirs(parts_dir, exist_ok=True)
+        manifest = load_yaml(manifest_path) if os.path.exists(manifest_path) else None
+        if manifest is None:
+            manifest = {'table_name': table_name, 'chunks': []}
+        elif manifest['table_name'] != table_name:
+            raise ValueError(f"'{parts_dir}' holds an unfinished export of '{manifest['table_name']}', not '{table_name}'")
+        quote = self.engine.dialect.identifier_preparer.quote
+        while True:
+            chunks = manifest['chunks']
+            last_id = chunks[-1]['last_id'] if chunks else None
+            rows_done = sum(chunk['rows'] for chunk in chunks)
+            filters = [] if last_id is None else [('id', '>', last_id)]
+            query, params = self.compile_statement(f'SELECT * FROM {quote(table_name)}', filters, ' ORDER BY id LIMIT :chunk_size')
+            params['chunk_size'] = chunk_size
+            chunk = pd.read_sql(query, self.engine, params=params)
+            if chunk.empty:
+                break
+            # numbering the rows carries on from the previous chunk, so the joined file has one continuous index
+            chunk.index = range(rows_done, rows_done + len(chunk))
+            part_name = f'part-{len(chunks):05d}.csv'
+            with atomic_write(os.path.join(parts_dir, part_name)) as temp_path:
+                chunk.to_csv(temp_path, header=not chunks)
+            chunks.append({'file': part_name, 'last_id': int(chunk['id'].max()), 'rows': len(chunk)})
+            with atomic_write(manifest_path) as temp_path, open(temp_path, 'w') as file:
+                yaml.safe_dump(manifest, file)
+        with atomic_write(f'{path}.csv{csv_extensions[compression]}') as temp_path:
+            with open_compressed(temp_path, compression) as output:
+                for chunk in manifest['chunks']:
+                    with open(os.path.join(parts_dir, chunk['file']), 'rb') as part:
+                        shutil.copyfileobj(part, output)
+        shutil.rmtree(parts_dir)
+        return sum(chunk['rows'] for chunk in manifest['chunks'])
+
+    # use_schema applies loan_payments_dtypes to any matching columns, set it to False to let pandas infer the dtypes
+    # engine='pyarrow' parses the file on several threads with pyarrow's csv reader, block_size is how many bytes each thread parses at a time
+    # With a Polars backend the file is read by Polars' own multithreaded reader (engine and block_size only apply to pandas)
+    # backend overrides the connector's backend for this one call
+    def read_csv(self, path, use_schema=True, engine='c', block_size=None, backend=None):
+        backend = backend or self.backend
+        header = csv_header(path)
+        indexed = has_index_column(header)
+        dtypes = None
+        if use_schema:
+            dtypes = {column: dtype for column, dtype in loan_payments_dtypes.items() if column in header}
+        if backend != 'pandas':
+            return self.read_csv_polars(path, dtypes, lazy=backend == 'polars-lazy', indexed=indexed)
+        if engine == 'pyarrow':
+            return self.read_csv_arrow(path, dtypes, block_size, indexed=indexed)
+        with open_csv(path) as source:
+            df = pd.read_csv(source, index_col=0 if indexed else None, dtype=dtypes, engine=engine)
+        return df
+
+    # Polars has no index, so the csv's unnamed index column is dropped if it has one
+    # Columns in the schema are read as text or floats and then cast, since Polars can't parse '5.0' straight into an integer
+    def read_csv_polars(self, path, dtypes=None, lazy=False, indexed=True):
+        import polars as pl
+        dtypes = dtypes or {}
+        polars_types = {
+            'category': pl.Categorical,
+            'int8': pl.Int8,
+            'int16': pl.Int16,
+            'int32': pl.Int32,
+            'Int8': pl.Int8,
+            'Int16': pl.Int16,
+            'float32': pl.Float32,
+            'float64': pl.Float64,
+        }
+        overrides = {column: pl.String if dtype == 'category' else pl.Float64 for column, dtype in dtypes.items()}
+        if str(path).endswith('.lz4'):
+            with open_csv(path) as source:
+                frame = pl.read_csv(source, schema_overrides=overrides).lazy()
+        else:
+            frame = pl.scan_csv(f'{path}', schema_overrides=overrides)
+        if indexed:
+            frame = frame.drop(frame.collect_schema().names()[0])
+        frame = frame.with_columns([pl.col(column).cast(polars_types[dtype]) for column, dtype in dtypes.items()])
+        return frame if lazy else frame.collect()
+
+    def read_csv_arrow(self, path, dtypes=None, block_size=None, indexed=True):
+        import pyarrow as pa
+        from pyarrow import csv
+        dtypes = dtypes or {}
+        # categoricals are dictionary encoded while parsing so the strings are never materialised one per row
+        column_types = {column: pa.dictionary(pa.int32(), pa.string()) for column, dtype in dtypes.items() if dtype == 'category'}
+        read_options = csv.ReadOptions(use_threads=True, block_size=block_size)
+        convert_options = csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+        with open_csv(path) as source:
+            table = csv.read_csv(source, read_options=read_options, convert_options=convert_options)
+        # self_destruct frees each arrow column as soon as it is converted, and split_blocks avoids consolidating columns into one big copy
+        df = table.to_pandas(self_destruct=True, split_blocks=True)
+        del table
+        if indexed:
+            df = df.set_index(df.columns[0])
+            df.index.name = None
+        remaining = {column: dtype for column, dtype in dtypes.items() if dtype != 'category'}
+        return df.astype(remaining) if remaining else df
+
+    # Creating a method to summarise a csv that is too big to load, reading it chunksize rows at a time
+    # Only one chunk is in memory at once, so memory use stays flat however big the file is
+    # Returns a TableProfile, use .summary() for the per-column statistics and .value_counts(column) for categorical columns
+    # workers is passed on to profile to summarise several chunks at once
+    def summarise_csv(self, path, chunksize=100000, use_schema=True, workers=None):
+        header = csv_header(path)
+        dtypes = None
+        if use_schema:
+            dtypes = {column: dtype for column, dtype in loan_payments_dtypes.items() if column in header}
+        index_col = 0 if has_index_column(header) else None
+        with open_csv(path) as source, pd.read_csv(source, index_col=index_col, dtype=dtypes, chunksize=chunksize) as chunks:
+            return profile(chunks, workers=workers)
+
+    # Creating methods to export to and read from columnar formats, which keep dtypes and are much quicker to load than csv
+    # compression can be 'snappy', 'gzip', 'brotli', 'zstd', 'lz4' or None
+    # row_group_size controls how many rows go into each row group, which is the unit filters can skip over on read
+    def export_to_parquet(self, path, compression='snappy', row_group_size=10000):
+        with atomic_write(f'{path}.parquet') as temp_path:
+            self.df.to_parquet(temp_path, engine='pyarrow', compression=compression, row_group_size=row_group_size)
+
+    # columns only loads the named columns, filters skips row groups that can't match,
+    # e.g. filters=[('loan_status', '==', 'Charged Off'), ('loan_amount', '>', 10000)]
+    def read_parquet(self, path, columns=None, filters=None):
+        if self.backend == 'polars-lazy' and filters is None:
+            import polars as pl
+            frame = pl.scan_parquet(f'{path}')
+            return frame if columns is None else frame.select(columns)
+        df = pd.read_parquet(f'{path}', engine='pyarrow', columns=columns, filters=filters)
+        return self.to_backend(df)
+
+    # Creating a method to export to Parquet along with small sidecar index files for looking up individual loans
+    # The rows are sorted by id and written row_group_size rows per row group, and for each key column
+    # a sorted '<path>.parquet.<key>.idx' file records which row group every key value is in
+    def export_to_parquet_indexed(self, path, keys=('id', 'member_id'), compression='snappy', row_group_size=10000):
+        df = self.df.sort_values('id', kind='stable').reset_index(drop=True)
+        data_path = f'{path}.parquet'
+        with atomic_write(data_path) as temp_path:
+            df.to_parquet(temp_path, engine='pyarrow', compression=compression, row_group_size=row_group_size, index=False)
+        row_groups = (df.index // row_group_size).astype('int32')
+        for key in keys:
+            index = pd.DataFrame({key: df[key].to_numpy(), 'row_group': row_groups.to_numpy()}).sort_values(key, kind='stable')
+            with atomic_write(f'{data_path}.{key}.idx') as temp_path:
+                index.to_parquet(temp_path, engine='pyarrow', index=False)
+
+    # Creating a method to fetch loans by id (or member_id) from a file written by export_to_parquet_indexed
+    # Only the row groups holding the requested keys are read, so lookups stay quick however big the file gets
+    # The sidecar index is kept in memory after the first lookup on a file
+    def lookup(self, path, ids, key='id', columns=None):
+        import pyarrow.parquet as pq
+        index_path = f'{path}.{key}.idx'
+        modified = os.path.getmtime(index_path)
+        cached = self.lookup_indexes.get(index_path)
+        if cached is None or cached[0] != modified:
+            cached = (modified, pd.read_parquet(index_path, engine='pyarrow'))
+            self.lookup_indexes[index_path] = cached
+        index = cached[1]
+        ids = pd.unique(pd.Series(list(ids), dtype=index[key].dtype))
+        # the index is sorted by key, so searchsorted finds where each id starts and ends without scanning the whole index
+        # (member_id can appear more than once, so every matching entry's row group is used)
+        keys = index[key].to_numpy()
+        groups = index['row_group'].to_numpy()
+        starts = keys.searchsorted(ids, side='left')
+        ends = keys.searchsorted(ids, side='right')
+        row_groups = sorted({int(group) for start, end in zip(starts, ends) for group in groups[start:end]})
+        parquet_file = pq.ParquetFile(path)
+        read_columns = None if columns is None else list(dict.fromkeys(list(columns) + [key]))
+        if row_groups:
+            table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+        else:
+            table = parquet_file.schema_arrow.empty_table()
+        df = table.to_pandas()
+        df = df[df[key].isin(ids)].reset_index(drop=True)
+        return df if columns is None else df[list(columns)]
+
+    # Creating a method to save the dataframe as a folder of NumPy files that can be memory mapped by read_column_store
+    # Numeric and datetime columns are saved as one .npy file each, text and categorical columns as integer codes in a .npy file
+    # plus their categories in a .categories.npy file, and a columns.yaml file records each column's name and dtype
+    # Nullable integer columns are stored as floats so that their missing values survive as NaN, and period columns as their integer ordinals
+    # An existing folder is only replaced if it has a columns.yaml file, i.e. it is an earlier column store
+    def export_to_column_store(self, path):
+        if os.path.exists(path) and not os.path.exists(os.path.join(path, 'columns.yaml')):
+            raise FileExistsError(f"'{path}' already exists and isn't a column store written by export_to_column_store")
+        temp_path = make_scratch_folder(path)
+        try:
+            layout = []
+            for number, column in enumerate(self.df.columns):
+                values = self.df[column]
+                file_name = f'{number:03d}'
+                is_numeric = pd.api.types.is_numeric_dtype(values.dtype) or pd.api.types.is_bool_dtype(values.dtype)
+                if isinstance(values.dtype, pd.PeriodDtype):
+                    np.save(os.path.join(temp_path, f'{file_name}.npy'), values.array.asi8)
+                    layout.append({'name': str(column), 'file': file_name, 'kind': 'period', 'dtype': str(values.dtype)})
+                elif pd.api.types.is_extension_array_dtype(values.dtype) and is_numeric:
+                    np.save(os.path.join(temp_path, f'{file_name}.npy'), values.to_numpy(dtype='float64', na_value=np.nan))
+                    layout.append({'name': str(column), 'file': file_name, 'kind': 'numeric', 'dtype': str(values.dtype)})
+                elif isinstance(values.dtype, np.dtype) and values.dtype != object:
+                    np.save(os.path.join(temp_path, f'{file_name}.npy'), values.to_numpy())
+                    layout.append({'name': str(column), 'file': file_name, 'kind': 'numeric', 'dtype': str(values.dtype)})
+                else:
+                    categorical = values.astype('category')
+                    np.save(os.path.join(temp_path, f'{file_name}.npy'), categorical.cat.codes.to_numpy())
+                    np.save(os.path.join(temp_path, f'{file_name}.categories.npy'), categorical.cat.categories.astype(str).to_numpy(dtype='U'))
+                    layout.append({'name': str(column), 'file': file_name, 'kind': 'category'})
+            with open(os.path.join(temp_path, 'columns.yaml'), 'w') as file:
+                yaml.safe_dump(layout, file, sort_keys=False)
+        except BaseException:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+        # swapping the finished folder into place so a half-written store is never read
+        replace_folder(temp_path, path)
+
+    # Creating a method to open a column store with memory mapping, so no data is read until it is used
+    # and every process that opens the same store shares one copy of it in the operating system's page cache
+    # The arrays are read-only views onto the files, and categorical columns are rebuilt from their codes without copying them
+    # Nullable integer and period columns are converted back to their original dtype, which does copy those few columns
+    def read_column_store(self, path, columns=None):
+        layout = load_yaml(os.path.join(path, 'columns.yaml'))
+        if columns is not None:
+            layout = [entry for entry in layout if entry['name'] in columns]
+        data = {}
+        for entry in layout:
+            values = np.load(os.path.join(path, f"{entry['file']}.npy"), mmap_mode='r')
+            if entry['kind'] == 'category':
+                categories = np.load(os.path.join(path, f"{entry['file']}.categories.npy"))
+                data[entry['name']] = pd.Categorical.from_codes(values, categories=categories, validate=False)
+            elif entry['kind'] == 'period':
+                data[entry['name']] = pd.arrays.PeriodArray(np.asarray(values), dtype=pd.api.types.pandas_dtype(entry['dtype']))
+            elif entry['dtype'] != str(values.dtype):
+                data[entry['name']] = pd.array(values).astype(entry['dtype'])
+            else:
+                data[entry['name']] = values
+        return pd.DataFrame(data, copy=False)
+
+    # Creating a method to run SQL directly over an exported .csv or .parquet file (or a folder of Parquet files) with DuckDB
+    # .csv files can be gzip or zstd compressed, but not lz4 compressed as DuckDB can't read those
+    # The file is available in the query as a table called loans, DuckDB reads it on all cores and only the columns
+    # and row groups the query needs, and only the (usually small) result comes back as a dataframe, e.g.
+    # query_file("loan payments.parquet", "SELECT grade, AVG(int_rate) AS mean_rate FROM loans GROUP BY grade")
+    def query_file(self, path, query, threads=None):
+        import duckdb
+        escaped = str(path).replace("'", "''")
+        if os.path.isdir(path):
+            source = f"read_parquet('{os.path.join(escaped, '**', '*.parquet')}', hive_partitioning = true)"
+        elif str(path).lower().endswith('.parquet'):
+            source = f"read_parquet('{escaped}')"
+        elif str(path).lower().endswith('.lz4'):
+            raise ValueError(f"DuckDB can't read lz4 compressed files like '{path}', export it with compression=None, 'gzip' or 'zstd' instead")
+        elif str(path).lower().endswith(tuple(f'.csv{extension}' for extension in csv_extensions.values())):
+            source = f"read_csv_auto('{escaped}', header = true)"
+        else:
+            raise ValueError(f"'{path}' isn't a .parquet file, a .csv file (optionally .gz or .zst compressed) or a folder of Parquet files")
+        connection = duckdb.connect()
+        try:
+            if threads is not None:
+                connection.execute(f'SET threads = {int(threads)}')
+            connection.execute(f'CREATE VIEW loans AS SELECT * FROM {source}')
+            return connection.execute(query).df()
+        finally:
+            connection.close()
+
+    # Feather (Arrow IPC) files are uncompressed or use 'lz4'/'zstd', and are the fastest to load back in
+    def export_to_feather(self, path, compression='lz4'):
+        with atomic_write(f'{path}.feather') as temp_path:
+            self.df.reset_index(drop=True).to_feather(temp_path, compression=compression)
+
+    def read_feather(self, path, columns=None):
+        df = pd.read_feather(f'{path}', columns=columns)
+        return df
+
+    # Creating a method to export to a folder of Parquet files split up by issue year and grade, e.g. path/issue_year=2021/grade=A/
+    # Each partition is written on its own thread (pyarrow releases the GIL while encoding and compressing)
+    # The dataset is written to a new scratch folder and only swapped in once every partition has been written, so a failed export
+    # leaves the previous dataset untouched. A marker file is written into every dataset folder, and an existing folder
+    # without one is never deleted, in case path points at something other than an earlier export
+    def export_to_parquet_dataset(self, path, partition_cols=('issue_year', 'grade'), compression='snappy', max_workers=None):
+        if os.path.exists(path) and not os.path.exists(os.path.join(path, dataset_marker)):
+            raise FileExistsError(f"'{path}' already exists and isn't a dataset written by export_to_parquet_dataset")
+        df = self.df
+        if 'issue_year' in partition_cols and 'issue_year' not in df.columns:
+            df = df.assign(issue_year=parse_month_year(df['issue_date']).dt.year.astype('Int16'))
+        partition_cols = list(partition_cols)
+        temp_path = make_scratch_folder(path)
+
+        def write_partition(keys, partition):
+            keys = keys if isinstance(keys, tuple) else (keys,)
+            folders = [f'{column}={"__HIVE_DEFAULT_PARTITION__" if pd.isna(key) else key}' for column, key in zip(partition_cols, keys)]
+            folder = os.path.join(temp_path, *folders)
+            os.makedirs(folder, exist_ok=True)
+            partition.drop(columns=partition_cols).to_parquet(
+                os.path.join(folder, 'part-0.parquet'), engine='pyarrow', compression=compression, index=False
+            )
+
+        try:
+            groups = df.groupby(partition_cols, dropna=False, observed=True, sort=False)
+            with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+                # list() makes sure any error raised while writing a partition is raised here
+                list(executor.map(lambda group: write_partition(*group), groups))
+            with open(os.path.join(temp_path, dataset_marker), 'w') as file:
+                yaml.safe_dump({'partition_cols': partition_cols}, file)
+        except BaseException:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+        replace_folder(temp_path, path)
 
-    def read_csv(self, path):
-        df = pd.read_csv(f'{path}', index_col=0)
+    # filters on the partition columns skip whole folders without opening them,
+    # e.g. read_parquet_dataset('loans', filters=[('issue_year', '>=', 2020), ('grade', 'in', ['A', 'B'])])
+    def read_parquet_dataset(self, path, columns=None, filters=None):
+        df = pd.read_parquet(f'{path}', engine='pyarrow', columns=columns, filters=filters)
         return df
 
 # Testing methods below, will remove later
 
-# test = RDSDatabaseConnector(credentials)
-# test.start_sqlalchemy_engine()
+# test = RDSDatabaseConnector()
+# polars_test = RDSDatabaseConnector(backend='polars-lazy')
+# test.start_sqlalchemy_engine(pool_size=10, pool_recycle=900)
+# print(pool_statistics())
 # test.get_data('loan_payments')
+# test.get_data('loan_payments', partitions=8)
+# test.get_data('loan_payments', columns=['id', 'grade', 'loan_amount'], filters=[('loan_status', '==', 'Charged Off')])
+# sample = test.get_data('loan_payments', sample=0.05, stratify_by='loan_status', seed=42)
+# loan_payments = asyncio.run(test.get_data_async('loan_payments'))
+# test.aggregate('loan_payments', ['grade'], {'loan_amount': 'sum', 'total_payment': 'sum', 'recoveries': 'sum'})
+# for chunk in test.stream_data('loan_payments', chunk_size=5000):
+#     print(chunk.shape)
+# test.copy_data('loan_payments')
+# cache = TableCache('cache', max_bytes=500 * 1024 ** 2)
+# test.get_data_cached('loan_payments', cache)
+# print(test.sync_data('loan_payments', 'loan payments.csv'))
 # test.export_to_csv("loan payments")
+# test.export_to_csv("loan payments", compression='zstd', index=False, parallel=True)
+# test.export_table_to_csv('loan_payments', "loan payments", chunk_size=10000, compression='gzip')
 # df = test.read_csv("loan payments.csv")
+# df = convert_month_year_columns(df, to='period')
+# df = test.read_csv("loan payments.csv", engine='pyarrow', block_size=4 * 1024 ** 2)
+# print(memory_report(test.read_csv("loan payments.csv", use_schema=False), df))
+# print(test.summarise_csv("loan payments.csv").summary())
+# print(profile(test.stream_data('loan_payments', chunk_size=50000), workers=4).summary())
+# test.export_to_parquet("loan payments", compression='zstd')
+# df = test.read_parquet("loan payments.parquet", columns=['loan_status', 'loan_amount', 'int_rate'])
+# test.export_to_parquet_indexed("loan payments")
+# test.lookup("loan payments.parquet", [38676116, 38656203])
+# test.export_to_column_store("loan payments store")
+# df = test.read_column_store("loan payments store")
+# test.query_file("loan payments.csv", "SELECT purpose, COUNT(*) AS loans FROM loans GROUP BY purpose")
+# test.export_to_parquet_dataset("loan payments dataset")
+# df = test.read_parquet_dataset("loan payments dataset", filters=[('issue_year', '==', 2021), ('grade', '==', 'A')])
 # df.head(10)
 
 """ 